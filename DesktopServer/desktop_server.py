@@ -5,10 +5,11 @@ import uuid
 from datetime import datetime
 import json
 import socket
-import subprocess
-import platform
 import signal
 import sys
+import threading
+import time
+import psutil
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -35,53 +36,355 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_local_ip():
-    """Get the local IP address of the machine"""
+def enumerate_local_ips():
+    """List usable IPv4 addresses from the network interfaces that are up"""
+    stats = psutil.net_if_stats()
+    ips = []
+    for name, addresses in psutil.net_if_addrs().items():
+        if name in stats and not stats[name].isup:
+            continue
+        for address in addresses:
+            if address.family != socket.AF_INET:
+                continue
+            # Skip loopback and link-local (no DHCP) addresses
+            if address.address.startswith('127.') or address.address.startswith('169.254.'):
+                continue
+            ips.append(address.address)
+    return ips
+
+def route_probe_ip():
+    """Ask the OS which local address routes to the internet (connect() on UDP sends no packets)"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        # Method 1: Connect to a remote address to get local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+def detect_local_ip():
+    """Detect the LAN IP without subprocesses: routing probe first, interfaces if offline"""
+    try:
+        return route_probe_ip()
+    except Exception:
+        pass
+    try:
+        ips = enumerate_local_ips()
+        if ips:
+            return ips[0]
+    except Exception as e:
+        print(f"Interface enumeration failed: {str(e)}")
+    try:
+        local_ip = socket.gethostbyname(socket.gethostname())
+        if not local_ip.startswith('127.'):
+            return local_ip
+    except Exception:
+        pass
+    return "192.168.1.100"  # Fallback
+
+# ----------------------------
+# Cached local IP
+# ----------------------------
+# Detection runs once at startup and then on a timer, so /ip never blocks on a
+# socket connect.
+IP_REFRESH_INTERVAL = 60  # seconds
+
+ip_cache = {'ip': None, 'updated_at': None}
+ip_cache_lock = threading.Lock()
+
+def refresh_ip_cache():
+    """Re-detect the local IP and store it in the cache"""
+    local_ip = detect_local_ip()
+    with ip_cache_lock:
+        if local_ip != ip_cache['ip'] and ip_cache['ip'] is not None:
+            print(f"Local IP changed: {ip_cache['ip']} -> {local_ip}")
+        ip_cache['ip'] = local_ip
+        ip_cache['updated_at'] = datetime.now().isoformat()
+    return local_ip
+
+def get_cached_ip():
+    """Return the cached local IP, detecting it first if the cache is empty"""
+    with ip_cache_lock:
+        local_ip = ip_cache['ip']
+    return local_ip if local_ip else refresh_ip_cache()
+
+def ip_refresh_loop():
+    """Background loop that keeps the IP cache fresh"""
+    while True:
+        time.sleep(IP_REFRESH_INTERVAL)
+        try:
+            refresh_ip_cache()
+        except Exception as e:
+            print(f"IP refresh error: {str(e)}")
+
+# ----------------------------
+# LAN discovery responder
+# ----------------------------
+# The Android app broadcasts DISCOVERY_REQUEST on DISCOVERY_PORT and gets back a
+# small JSON reply with the address to use, so no manual IP entry is needed.
+SERVER_PORT = 5001
+DISCOVERY_PORT = 5002
+DISCOVERY_REQUEST = b'CANISCAN_DISCOVER'
+
+def ip_for_peer(peer_ip):
+    """Find which local address routes to the peer (no packets are sent)"""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect((peer_ip, DISCOVERY_PORT))
         local_ip = s.getsockname()[0]
         s.close()
         return local_ip
     except Exception:
+        return get_cached_ip()
+
+def discovery_responder():
+    """Answer discovery broadcasts from the Android app"""
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', DISCOVERY_PORT))
+    except Exception as e:
+        print(f"Discovery responder disabled: {str(e)}")
+        return
+
+    print(f"Discovery responder listening on UDP port {DISCOVERY_PORT}")
+    while True:
         try:
-            # Method 2: Use hostname resolution
-            hostname = socket.gethostname()
-            local_ip = socket.gethostbyname(hostname)
-            if local_ip.startswith('127.'):
-                # If it's localhost, try alternative method
-                return get_local_ip_alternative()
-            return local_ip
-        except Exception:
-            return get_local_ip_alternative()
+            data, addr = sock.recvfrom(1024)
+            if data.strip() != DISCOVERY_REQUEST:
+                continue
+            reply = json.dumps({
+                'service': 'caniscan-desktop',
+                'ip': ip_for_peer(addr[0]),
+                'port': SERVER_PORT
+            })
+            sock.sendto(reply.encode('utf-8'), addr)
+        except Exception as e:
+            print(f"Discovery error: {str(e)}")
+
+# ----------------------------
+# Upload retention
+# ----------------------------
+# Per-folder quotas, pins and "analyzed" flags are kept in a small JSON file in the
+# uploads folder. Nothing is evicted until a quota is saved for a folder through
+# /retention/quotas. The background job then evicts old images and images over quota,
+# skipping pinned and analyzed ones, and removes sidecar files (e.g. photo.jpg.json)
+# whose source image is gone.
+RETENTION_FILE = os.path.join(UPLOAD_FOLDER, '.retention.json')
+DEFAULT_RETENTION_POLICY = {
+    'max_age_days': None,      # Evict images older than this (None to disable)
+    'max_folder_bytes': None,  # Evict oldest images once a folder is over this (None to disable)
+    'keep_pinned': True,
+    'keep_analyzed': True
+}
+DERIVED_SUFFIXES = ('.json', '.txt')  # Sidecar files named <image><suffix>
+RETENTION_INTERVAL = 3600          # seconds between background runs
+RETENTION_DELETES_PER_SECOND = 5   # Throttle so cleanup never competes with uploads
+UPLOAD_QUIET_SECONDS = 30          # Pause cleanup while uploads are arriving
+
+retention_lock = threading.Lock()
+retention_state_lock = threading.Lock()
+last_upload_time = 0.0
+last_retention_run = None
+
+def load_retention_state():
+    """Load quotas, pinned and analyzed paths from the retention file"""
+    state = {'quotas': {}, 'pinned': [], 'analyzed': []}
+    if os.path.exists(RETENTION_FILE):
+        try:
+            with open(RETENTION_FILE, 'r') as f:
+                state.update(json.load(f))
+        except Exception as e:
+            print(f"Could not read retention file: {str(e)}")
+    return state
+
+def save_retention_state(state):
+    """Write the retention file atomically"""
+    tmp_path = RETENTION_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, RETENTION_FILE)
+
+def policy_for_folder(state, folder):
+    """Merge the default policy with any quota configured for this folder"""
+    policy = dict(DEFAULT_RETENTION_POLICY)
+    policy.update(state['quotas'].get(folder, {}))
+    return policy
+
+def source_image_for(filename):
+    """Return the image a derived file belongs to, or None if it isn't a derived file"""
+    if allowed_file(filename):
+        return None  # Images are never treated as derived files
+    lower = filename.lower()
+    for suffix in DERIVED_SUFFIXES:
+        if lower.endswith(suffix):
+            source = filename[:-len(suffix)]
+            return source if allowed_file(source) else None
+    return None
+
+def is_protected(state, path):
+    """True if the image is pinned/analyzed and its folder's policy keeps such images"""
+    folder = path.rsplit('/', 1)[0] if '/' in path else ''
+    policy = policy_for_folder(state, folder)
+    return (policy['keep_pinned'] and path in state['pinned']) or \
+           (policy['keep_analyzed'] and path in state['analyzed'])
+
+def validate_quota(data):
+    """Pick the policy keys out of a request, or return an error message"""
+    quota = {}
+    for key in DEFAULT_RETENTION_POLICY:
+        if key not in data:
+            continue
+        value = data[key]
+        if key.startswith('keep_'):
+            if not isinstance(value, bool):
+                return None, f'{key} must be true or false'
+        elif value is not None and (isinstance(value, bool) or
+                                    not isinstance(value, (int, float)) or value < 0):
+            return None, f'{key} must be a non-negative number or null'
+        quota[key] = value
+    return quota, None
+
+def plan_retention():
+    """Work out what retention would delete, without deleting anything"""
+    state = load_retention_state()
+    now = time.time()
+    evictions = []
+    orphans = []
+    folders = []
+
+    for root, dirs, files in os.walk(UPLOAD_FOLDER):
+        folder = os.path.relpath(root, UPLOAD_FOLDER).replace('\\', '/')
+        folder = '' if folder == '.' else folder
+        policy = policy_for_folder(state, folder)
+
+        images = []
+        for name in files:
+            if not allowed_file(name):
+                continue
+            path = f'{folder}/{name}' if folder else name
+            full_path = os.path.join(root, name)
+            images.append({
+                'path': path,
+                'size': os.path.getsize(full_path),
+                'mtime': os.path.getmtime(full_path),
+                'protected': is_protected(state, path)
+            })
+        images.sort(key=lambda x: x['mtime'])
+
+        evicted = set()
+        if policy['max_age_days'] is not None:
+            cutoff = now - policy['max_age_days'] * 86400
+            for image in images:
+                if not image['protected'] and image['mtime'] < cutoff:
+                    evictions.append({'path': image['path'], 'size': image['size'], 'reason': 'age'})
+                    evicted.add(image['path'])
+
+        total_bytes = sum(image['size'] for image in images if image['path'] not in evicted)
+        if policy['max_folder_bytes'] is not None:
+            for image in images:
+                if total_bytes <= policy['max_folder_bytes']:
+                    break
+                if image['protected'] or image['path'] in evicted:
+                    continue
+                evictions.append({'path': image['path'], 'size': image['size'], 'reason': 'quota'})
+                evicted.add(image['path'])
+                total_bytes -= image['size']
+
+        # Derived files whose image no longer exists (or is about to be evicted)
+        image_names = {os.path.basename(image['path']) for image in images
+                       if image['path'] not in evicted}
+        for name in files:
+            source = source_image_for(name)
+            if source is not None and source not in image_names:
+                path = f'{folder}/{name}' if folder else name
+                orphans.append({'path': path, 'size': os.path.getsize(os.path.join(root, name))})
+
+        folders.append({
+            'folder': folder,
+            'image_count': len(images),
+            'bytes_after': total_bytes,
+            'policy': policy
+        })
+
+    return {
+        'evictions': evictions,
+        'orphans': orphans,
+        'folders': folders,
+        'bytes_reclaimed': sum(e['size'] for e in evictions) + sum(o['size'] for o in orphans)
+    }
+
+def uploads_busy():
+    """True if an upload arrived recently, so cleanup should wait"""
+    return time.time() - last_upload_time < UPLOAD_QUIET_SECONDS
+
+def apply_retention():
+    """Delete what plan_retention() selects, throttled and paused during uploads"""
+    global last_retention_run
+    if not retention_lock.acquire(blocking=False):
+        return None  # A run is already in progress
 
-def get_local_ip_alternative():
-    """Alternative method using system commands"""
     try:
-        system = platform.system().lower()
-        if system == "windows":
-            # Windows command
-            result = subprocess.run(['ipconfig'], capture_output=True, text=True)
-            lines = result.stdout.split('\n')
-            for i, line in enumerate(lines):
-                if 'Wireless LAN adapter Wi-Fi:' in line or 'Ethernet adapter Ethernet:' in line:
-                    # Look for IPv4 address in next few lines
-                    for j in range(i+1, min(i+10, len(lines))):
-                        if 'IPv4 Address' in lines[j]:
-                            ip = lines[j].split(':')[-1].strip()
-                            if not ip.startswith('127.'):
-                                return ip
-        else:
-            # Linux/Mac command
-            result = subprocess.run(['hostname', '-I'], capture_output=True, text=True)
-            ips = result.stdout.strip().split()
-            for ip in ips:
-                if not ip.startswith('127.'):
-                    return ip
-    except Exception:
-        pass
-    return "192.168.1.100"  # Fallback
+        plan = plan_retention()
+        deleted = 0
+        bytes_reclaimed = 0
+        for entry in plan['evictions'] + plan['orphans']:
+            while uploads_busy():
+                time.sleep(UPLOAD_QUIET_SECONDS)
+
+            # The run can take a while, so re-check flags set since the plan was built
+            full_path = os.path.join(UPLOAD_FOLDER, entry['path'])
+            if 'reason' in entry:
+                with retention_state_lock:
+                    if is_protected(load_retention_state(), entry['path']):
+                        continue
+            elif os.path.exists(os.path.join(os.path.dirname(full_path),
+                                             source_image_for(os.path.basename(full_path)))):
+                continue  # Source image came back, no longer an orphan
+
+            try:
+                os.remove(full_path)
+                deleted += 1
+                bytes_reclaimed += entry['size']
+            except FileNotFoundError:
+                pass
+            time.sleep(1.0 / RETENTION_DELETES_PER_SECOND)
+
+        # Drop flags for images that no longer exist
+        with retention_state_lock:
+            state = load_retention_state()
+            for key in ('pinned', 'analyzed'):
+                state[key] = [p for p in state[key]
+                              if os.path.isfile(os.path.join(UPLOAD_FOLDER, p))]
+            save_retention_state(state)
+
+        last_retention_run = {
+            'finished_at': datetime.now().isoformat(),
+            'deleted': deleted,
+            'bytes_reclaimed': bytes_reclaimed
+        }
+        if deleted:
+            print(f"Retention removed {deleted} files ({bytes_reclaimed} bytes)")
+        return last_retention_run
+    finally:
+        retention_lock.release()
+
+def retention_loop():
+    """Background loop that applies the retention policy periodically"""
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            # Only report (via /retention/report) until a policy has been saved
+            if load_retention_state()['quotas']:
+                apply_retention()
+        except Exception as e:
+            print(f"Retention error: {str(e)}")
+
+def start_background_threads():
+    """Prime the IP cache and start the refresh, discovery and retention threads"""
+    refresh_ip_cache()
+    threading.Thread(target=ip_refresh_loop, daemon=True).start()
+    threading.Thread(target=discovery_responder, daemon=True).start()
+    threading.Thread(target=retention_loop, daemon=True).start()
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -96,13 +399,13 @@ def health_check():
 def get_ip():
     """Get the local IP address of the server"""
     try:
-        local_ip = get_local_ip()
-        print(f"Detected local IP: {local_ip}")
+        local_ip = get_cached_ip()
         return jsonify({
             'success': True,
             'ip': local_ip,
             'message': 'Local IP address retrieved successfully',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(),
+            'detected_at': ip_cache['updated_at']
         })
     except Exception as e:
         print(f"Failed to get IP address: {str(e)}")
@@ -116,6 +419,8 @@ def get_ip():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle image uploads from Android app"""
+    global last_upload_time
+    last_upload_time = time.time()
     try:
         if 'image' not in request.files:
             return jsonify({
@@ -357,6 +662,121 @@ def delete_image(filepath):
             'message': f'Failed to delete image: {str(e)}'
         }), 500
 
+@app.route('/retention/report', methods=['GET'])
+def retention_report():
+    """Dry run: show what the retention job would delete"""
+    try:
+        plan = plan_retention()
+        return jsonify({
+            'success': True,
+            'dry_run': True,
+            'evictions': plan['evictions'],
+            'orphans': plan['orphans'],
+            'folders': plan['folders'],
+            'bytes_reclaimed': plan['bytes_reclaimed'],
+            'last_run': last_retention_run
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Failed to build retention report: {str(e)}'
+        }), 500
+
+@app.route('/retention/run', methods=['POST'])
+def retention_run():
+    """Start a retention run in the background"""
+    if retention_lock.locked():
+        return jsonify({
+            'success': False,
+            'message': 'Retention is already running'
+        }), 409
+    threading.Thread(target=apply_retention, daemon=True).start()
+    return jsonify({
+        'success': True,
+        'message': 'Retention run started'
+    }), 202
+
+@app.route('/retention/mark', methods=['POST'])
+def retention_mark():
+    """Pin or mark an image as analyzed so retention keeps it"""
+    try:
+        data = request.get_json()
+        path = data.get('path', '').strip()
+
+        # Security check - prevent directory traversal
+        if not path or '..' in path or path.startswith('/'):
+            return jsonify({
+                'success': False,
+                'message': 'Invalid file path'
+            }), 400
+
+        if not os.path.isfile(os.path.join(UPLOAD_FOLDER, path)):
+            return jsonify({
+                'success': False,
+                'message': 'Image not found'
+            }), 404
+
+        with retention_state_lock:
+            state = load_retention_state()
+            for key in ('pinned', 'analyzed'):
+                if key in data:
+                    entries = set(state[key])
+                    if data[key]:
+                        entries.add(path)
+                    else:
+                        entries.discard(path)
+                    state[key] = sorted(entries)
+            save_retention_state(state)
+
+        return jsonify({
+            'success': True,
+            'message': 'Image retention flags updated',
+            'pinned': path in state['pinned'],
+            'analyzed': path in state['analyzed']
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Failed to update retention flags: {str(e)}'
+        }), 500
+
+@app.route('/retention/quotas', methods=['POST'])
+def retention_quotas():
+    """Set the retention policy for one folder ('' for the uploads root)"""
+    try:
+        data = request.get_json()
+        folder = data.get('folder', '').strip().strip('/')
+
+        if '..' in folder:
+            return jsonify({
+                'success': False,
+                'message': 'Invalid folder path'
+            }), 400
+
+        quota, error = validate_quota(data)
+        if error:
+            return jsonify({
+                'success': False,
+                'message': error
+            }), 400
+
+        with retention_state_lock:
+            state = load_retention_state()
+            state['quotas'][folder] = {**state['quotas'].get(folder, {}), **quota}
+            save_retention_state(state)
+
+        return jsonify({
+            'success': True,
+            'message': 'Folder quota updated',
+            'folder': folder,
+            'policy': policy_for_folder(state, folder)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Failed to update quota: {str(e)}'
+        }), 500
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
     """Shutdown the Flask server"""
@@ -532,16 +952,22 @@ if __name__ == '__main__':
     print("   - GET /images/<path> - View specific image")
     print("   - DELETE /images/<path> - Delete specific image")
     print("   - POST /folders - Create new folder")
+    print("   - GET /retention/report - Dry-run retention report")
+    print("   - POST /retention/run - Run retention now")
+    print("   - POST /retention/mark - Pin or mark an image as analyzed")
+    print("   - POST /retention/quotas - Set a folder's retention policy")
     print("   - POST /shutdown - Shutdown server")
     print("   - GET /health - Health check")
     print("   - GET /ip - Get local IP address")
+    print(f"   - UDP {DISCOVERY_PORT} - LAN discovery (send {DISCOVERY_REQUEST.decode()})")
     print("=" * 50)
     
     # Display detected IP address on startup
     try:
-        detected_ip = get_local_ip()
+        start_background_threads()
+        detected_ip = get_cached_ip()
         print(f"Detected local IP address: {detected_ip}")
-        print(f"Use this IP address in your phone app: http://{detected_ip}:5001")
+        print(f"Use this IP address in your phone app: http://{detected_ip}:{SERVER_PORT}")
     except Exception as e:
         print(f"Could not detect IP address: {e}")
         print("Default IP address: 192.168.1.100")
@@ -549,7 +975,7 @@ if __name__ == '__main__':
     print("=" * 50)
     
     try:
-        app.run(host='0.0.0.0', port=5001, debug=False, use_reloader=False)
+        app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, use_reloader=False)
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user.")
         sys.exit(0)
\ No newline at end of file
@@ -1,7 +1,12 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 from ultralytics import YOLO
-import cv2, base64, numpy as np, re, csv, os, bcrypt
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from collections import OrderedDict
+from inference_pool import InferencePool, top_detection
+import cv2, base64, numpy as np, re, csv, os, bcrypt, threading, time, json, hmac, hashlib
 
 # ----------------------------
 # Flask App Initialization
@@ -12,7 +17,92 @@ CORS(app)  # Enable Cross-Origin requests, necessary for Electron <-> Flask comm
 # ----------------------------
 # Load YOLO Model for Disease Detection
 # ----------------------------
-model = YOLO(r"runs\detect\train2\weights\best.pt")  # Path to trained YOLOv8 weights
+# Selectable model variants. "int8" is produced by quantize.py and is only offered
+# if its accuracy report says it stayed within the configured mAP threshold.
+MODEL_VARIANTS = {
+    "fp32": r"runs\detect\train2\weights\best.pt",  # Path to trained YOLOv8 weights
+    "int8": r"runs\detect\train2\weights\best_int8_openvino_model"
+}
+INT8_REPORT = r"runs\detect\train2\weights\int8_report.json"
+DEFAULT_VARIANT = os.environ.get("CANISCAN_MODEL_VARIANT", "fp32")
+
+def variant_available(variant):
+    """Check that a variant exists on disk and, for INT8, that its report accepted it."""
+    if variant not in MODEL_VARIANTS or not os.path.exists(MODEL_VARIANTS[variant]):
+        return False
+    if variant == "int8":
+        if not os.path.exists(INT8_REPORT):
+            return False
+        try:
+            with open(INT8_REPORT, "r") as f:
+                return json.load(f).get("accepted", False) is True
+        except (OSError, ValueError, AttributeError):
+            return False  # Unreadable or malformed report: don't offer the variant
+    return True
+
+loaded_models = {}
+loaded_models_lock = threading.Lock()
+
+def get_model(variant):
+    """Load a model variant on first use and reuse it afterwards."""
+    with loaded_models_lock:
+        if variant not in loaded_models:
+            loaded_models[variant] = YOLO(MODEL_VARIANTS[variant], task="detect")
+        return loaded_models[variant]
+
+if not variant_available(DEFAULT_VARIANT):
+    print(f"Model variant '{DEFAULT_VARIANT}' is unavailable or was refused by its report, using fp32")
+    DEFAULT_VARIANT = "fp32"
+
+# Optional pool of model replicas in separate processes for many-core CPUs.
+# Set CANISCAN_INFERENCE_WORKERS to the number of replicas (0 runs inference in-process).
+INFERENCE_WORKERS = int(os.environ.get("CANISCAN_INFERENCE_WORKERS", "0"))
+inference_pool = None  # Created in __main__ so spawned workers don't start their own pools
+
+# ----------------------------
+# Motion-Gated Inference
+# ----------------------------
+# Consecutive frames from the same client are compared using a tiny grayscale
+# thumbnail. If the frame barely changed, the previous detection is reused
+# instead of running YOLO again.
+FINGERPRINT_SIZE = (16, 16)
+FRAME_CHANGE_THRESHOLD = 0.03   # Mean absolute pixel difference (0-1) that counts as a new frame
+MAX_STALENESS_SECONDS = 2.0     # Always re-run inference after this long
+MAX_TRACKED_SESSIONS = 64
+
+frame_sessions = OrderedDict()  # session key -> {"fingerprint", "result", "analyzed_at"}
+frame_sessions_lock = threading.Lock()
+
+def frame_fingerprint(img):
+    """Downscale a frame to a small normalized grayscale thumbnail."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, FINGERPRINT_SIZE, interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32) / 255.0
+
+def get_reusable_result(session_key, fingerprint):
+    """Return the session's last result if the frame hasn't changed enough, else None."""
+    with frame_sessions_lock:
+        entry = frame_sessions.get(session_key)
+        if entry is None:
+            return None
+        frame_sessions.move_to_end(session_key)
+        if time.monotonic() - entry["analyzed_at"] > MAX_STALENESS_SECONDS:
+            return None
+        if float(np.mean(np.abs(fingerprint - entry["fingerprint"]))) >= FRAME_CHANGE_THRESHOLD:
+            return None
+        return entry["result"]
+
+def remember_result(session_key, fingerprint, result):
+    """Store the latest analyzed frame for a session, evicting the oldest sessions."""
+    with frame_sessions_lock:
+        frame_sessions[session_key] = {
+            "fingerprint": fingerprint,
+            "result": result,
+            "analyzed_at": time.monotonic()
+        }
+        frame_sessions.move_to_end(session_key)
+        while len(frame_sessions) > MAX_TRACKED_SESSIONS:
+            frame_sessions.popitem(last=False)
 
 # ----------------------------
 # User Database Setup
@@ -36,6 +126,102 @@ def verify_password(password, hashed):
     """Verify plain password against hashed password."""
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+# Bcrypt at cost 12 is ~250 ms of CPU per check. Run it in a small bounded pool so
+# a burst of logins can't take every core away from YOLO inference in /analyze.
+BCRYPT_WORKERS = int(os.environ.get("CANISCAN_BCRYPT_WORKERS", "1"))
+bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+def verify_password_bounded(password, hashed):
+    """Verify a password on the bcrypt worker pool instead of the request thread."""
+    return bcrypt_pool.submit(verify_password, password, hashed).result()
+
+# ----------------------------
+# Login Rate Limiting
+# ----------------------------
+LOGIN_MAX_ATTEMPTS = 5       # Attempts allowed per email...
+LOGIN_WINDOW_SECONDS = 60    # ...within this many seconds
+
+login_attempts = {}  # email -> list of attempt timestamps
+login_attempts_lock = threading.Lock()
+last_login_sweep = time.monotonic()
+
+def sweep_login_attempts(now):
+    """Drop emails whose attempts have all left the window (call with the lock held)."""
+    global last_login_sweep
+    if now - last_login_sweep < LOGIN_WINDOW_SECONDS:
+        return
+    for key in [k for k, attempts in login_attempts.items() if now - attempts[-1] >= LOGIN_WINDOW_SECONDS]:
+        del login_attempts[key]
+    last_login_sweep = now
+
+def login_rate_limited(email):
+    """Record a login attempt for this email and return True if it is over the limit."""
+    key = email.strip().lower()
+    now = time.monotonic()
+    with login_attempts_lock:
+        sweep_login_attempts(now)
+        attempts = [t for t in login_attempts.get(key, []) if now - t < LOGIN_WINDOW_SECONDS]
+        if len(attempts) >= LOGIN_MAX_ATTEMPTS:
+            login_attempts[key] = attempts
+            return True
+        attempts.append(now)
+        login_attempts[key] = attempts
+        return False
+
+# ----------------------------
+# Session Tokens
+# ----------------------------
+# Tokens are HMAC-signed, so checking one is a cheap signature check rather than
+# another bcrypt call. Set CANISCAN_SECRET_KEY to keep sessions valid across restarts.
+SECRET_KEY = os.environ.get("CANISCAN_SECRET_KEY") or os.urandom(32).hex()
+ACCESS_TOKEN_MAX_AGE = 15 * 60          # 15 minutes
+REFRESH_TOKEN_MAX_AGE = 7 * 24 * 3600   # 7 days
+
+access_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="caniscan-access")
+refresh_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="caniscan-refresh")
+
+# Refresh tokens carry a fingerprint of the user's stored password hash, so changing the
+# password (or its hash in users.csv) revokes every refresh token issued before it.
+# There is no server-side token store: refreshing does not invalidate the previous refresh
+# token, and a stolen one stays usable until it expires, the password changes, or
+# CANISCAN_SECRET_KEY is rotated (which revokes all sessions).
+def password_fingerprint(user):
+    """Short keyed digest of the stored password hash, used as a refresh token version."""
+    digest = hmac.new(SECRET_KEY.encode("utf-8"), user["password"].encode("utf-8"), hashlib.sha256)
+    return digest.hexdigest()[:16]
+
+def issue_tokens(user):
+    """Create a fresh access/refresh token pair for a user row."""
+    payload = {"email": user["email"].strip().lower(), "name": user["first_name"]}
+    return {
+        "token": access_serializer.dumps(payload),
+        "refresh_token": refresh_serializer.dumps({**payload, "pwd": password_fingerprint(user)}),
+        "expires_in": ACCESS_TOKEN_MAX_AGE
+    }
+
+def get_bearer_token():
+    """Extract the token from an 'Authorization: Bearer <token>' header."""
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        return auth_header[len("Bearer "):].strip()
+    return None
+
+def login_required(view):
+    """Reject requests without a valid, unexpired access token."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = get_bearer_token()
+        if not token:
+            return jsonify({"success": False, "message": "Missing session token"}), 401
+        try:
+            g.session_user = access_serializer.loads(token, max_age=ACCESS_TOKEN_MAX_AGE)
+        except SignatureExpired:
+            return jsonify({"success": False, "message": "Session expired"}), 401
+        except BadSignature:
+            return jsonify({"success": False, "message": "Invalid session token"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
 # ----------------------------
 # User Data Utilities
 # ----------------------------
@@ -116,16 +302,53 @@ def login():
     email = data.get("email", "").strip()
     password = data.get("password", "").strip()
 
+    if login_rate_limited(email):
+        return jsonify({"success": False, "message": "Too many login attempts. Please wait and try again."}), 429
+
     user = find_user_by_email(email)
-    if user and verify_password(password, user["password"]):
+    if user and verify_password_bounded(password, user["password"]):
         return jsonify({
             "success": True,
             "message": "Login successful",
-            "name": f"{user['first_name']}"
+            "name": f"{user['first_name']}",
+            **issue_tokens(user)
         })
     else:
         return jsonify({"success": False, "message": "Invalid credentials"}), 401
 
+@app.route('/refresh', methods=['POST'])
+def refresh():
+    """Exchange a valid refresh token for a new token pair without re-checking the password."""
+    data = request.get_json(silent=True)
+    refresh_token = data.get("refresh_token") if isinstance(data, dict) else None
+    if not isinstance(refresh_token, str) or not refresh_token:
+        return jsonify({"success": False, "message": "Invalid or expired refresh token"}), 401
+    try:
+        payload = refresh_serializer.loads(refresh_token, max_age=REFRESH_TOKEN_MAX_AGE)
+    except (SignatureExpired, BadSignature):
+        return jsonify({"success": False, "message": "Invalid or expired refresh token"}), 401
+
+    # Make sure the account still exists before handing out new tokens
+    user = find_user_by_email(payload["email"])
+    if not user:
+        return jsonify({"success": False, "message": "User no longer exists"}), 401
+
+    # Tokens issued before a password change are revoked
+    if not hmac.compare_digest(payload.get("pwd", ""), password_fingerprint(user)):
+        return jsonify({"success": False, "message": "Invalid or expired refresh token"}), 401
+
+    return jsonify({"success": True, **issue_tokens(user)})
+
+@app.route('/session', methods=['GET'])
+@login_required
+def session_info():
+    """Return the user behind the current access token."""
+    return jsonify({
+        "success": True,
+        "email": g.session_user["email"],
+        "name": g.session_user["name"]
+    })
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     """Analyze an image frame for disease using YOLOv8."""
@@ -135,18 +358,53 @@ def analyze():
     np_arr = np.frombuffer(frame_bytes, np.uint8)
     img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
-    results = model(img)
-    detections = results[0].boxes
+    # Optional per-request model variant, e.g. {"variant": "int8"}
+    variant = data.get('variant', DEFAULT_VARIANT)
+    if not isinstance(variant, str) or variant not in MODEL_VARIANTS:
+        return jsonify({'error': "Unknown model variant"}), 400
+    if variant != DEFAULT_VARIANT and not variant_available(variant):
+        return jsonify({'error': f"Model variant '{variant}' is not available"}), 400
+
+    # Streaming clients send a "session_id" to opt in to reusing the previous result when
+    # their frame has barely changed. Requests without one (e.g. single still images) always
+    # get fresh inference, since two different close-ups can look alike at 16x16.
+    session_id = data.get('session_id')
+    if session_id is not None and not isinstance(session_id, str):
+        return jsonify({'error': "session_id must be a string"}), 400
+    session_key = (session_id, variant) if session_id else None
+    if session_key is not None:
+        fingerprint = frame_fingerprint(img)
+        previous = get_reusable_result(session_key, fingerprint)
+        if previous is not None:
+            return jsonify({**previous, 'fresh': False})
 
-    if detections is None or len(detections) == 0:
-        return jsonify({'disease': "No disease detected", 'confidence': 0})
+    # The replica pool serves the default variant; other variants run in-process
+    # The pool falls back to in-process inference once all its workers have been given up on
+    if inference_pool is not None and inference_pool.available and variant == DEFAULT_VARIANT:
+        try:
+            top = inference_pool.infer(img)
+        except (RuntimeError, TimeoutError) as e:
+            return jsonify({'error': f"Inference failed: {str(e)}"}), 503
+    else:
+        top = top_detection(get_model(variant), img)
+
+    if top is None:
+        result = {'disease': "No disease detected", 'confidence': 0, 'variant': variant}
+    else:
+        disease, confidence = top
+        result = {'disease': disease, 'confidence': confidence, 'variant': variant}
 
-    # Pick the detection with highest confidence
-    top_conf_idx = np.argmax(detections.conf.cpu().numpy())
-    disease = model.names[int(detections.cls[top_conf_idx])]
-    confidence = float(detections.conf[top_conf_idx]) * 100
+    if session_key is not None:
+        remember_result(session_key, fingerprint, result)
+    return jsonify({**result, 'fresh': True})
 
-    return jsonify({'disease': disease, 'confidence': round(confidence, 2)})
+@app.route('/models', methods=['GET'])
+def list_models():
+    """List the model variants that can be selected for /analyze."""
+    return jsonify({
+        "default": DEFAULT_VARIANT,
+        "available": [v for v in MODEL_VARIANTS if variant_available(v)]
+    })
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -157,5 +415,11 @@ def health():
 # Start Flask Server
 # ----------------------------
 if __name__ == '__main__':
+    if INFERENCE_WORKERS > 0:
+        inference_pool = InferencePool(MODEL_VARIANTS[DEFAULT_VARIANT], INFERENCE_WORKERS)
+        print(f"Started {INFERENCE_WORKERS} inference workers ({inference_pool.threads} threads each)")
+    else:
+        get_model(DEFAULT_VARIANT)  # Preload the default variant at startup
+
     # Runs the Flask server on localhost:5000
     app.run(host='127.0.0.1', port=5000)
@@ -0,0 +1,256 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import psutil
+
+# ----------------------------
+# Pool Settings
+# ----------------------------
+MAX_FRAME_SIDE = 1920    # Larger frames are downscaled before being copied to shared memory
+SLOTS_PER_WORKER = 2     # Frames a worker can have queued (one running, one waiting)
+INFERENCE_TIMEOUT = 30   # seconds, for both waiting on a free slot and the inference itself
+RESTART_BACKOFF_MAX = 60 # seconds between restarts of a worker that keeps crashing
+MAX_RESTARTS = 5         # Consecutive crashes before a worker is given up on
+STABLE_SECONDS = 60      # A worker alive this long has its crash count reset
+SLOT_BYTES = MAX_FRAME_SIDE * MAX_FRAME_SIDE * 3
+
+def top_detection(model, img):
+    """Run YOLO on an image and return (disease, confidence %) for the best box, or None."""
+    detections = model(img, verbose=False)[0].boxes
+    if detections is None or len(detections) == 0:
+        return None
+    top_conf_idx = int(np.argmax(detections.conf.cpu().numpy()))
+    disease = model.names[int(detections.cls[top_conf_idx])]
+    confidence = float(detections.conf[top_conf_idx]) * 100
+    return disease, round(confidence, 2)
+
+def worker_main(weights, cores, threads, shm_names, tasks, results):
+    """Replica process: pin to its cores, load the model and serve frames from shared memory."""
+    try:
+        psutil.Process().cpu_affinity(cores)
+    except (AttributeError, psutil.Error):
+        pass  # cpu_affinity isn't available on macOS
+
+    # With the spawn context, the replica has already re-imported app.py as __mp_main__ (and with
+    # it torch) by this point. That's fine: torch creates its intra-op thread pool lazily, so
+    # set_num_threads still takes effect as long as it runs before the first inference.
+    import torch
+    from ultralytics import YOLO
+    torch.set_num_threads(threads)
+
+    model = YOLO(weights, task="detect")
+    slots = [shared_memory.SharedMemory(name=name) for name in shm_names]
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        request_id, slot, shape = task
+        try:
+            img = np.ndarray(shape, dtype=np.uint8, buffer=slots[slot].buf)
+            results.put((request_id, top_detection(model, img), None))
+        except Exception as e:
+            results.put((request_id, None, str(e)))
+
+    for shm in slots:
+        shm.close()
+
+class InferencePool:
+    """N model replicas in separate processes, fed through shared memory slots."""
+
+    def __init__(self, weights, num_workers, threads_per_worker=None):
+        self.weights = weights
+        self.num_workers = num_workers
+        self.ctx = mp.get_context("spawn")  # Fork is unsafe once torch has started threads
+
+        total_cores = psutil.cpu_count(logical=True) or os.cpu_count() or 1
+        cores_per_worker = max(1, total_cores // num_workers)
+        self.threads = threads_per_worker or cores_per_worker
+        self.cores = [
+            [(i * cores_per_worker + c) % total_cores for c in range(cores_per_worker)]
+            for i in range(num_workers)
+        ]
+
+        self.shm = [
+            [shared_memory.SharedMemory(create=True, size=SLOT_BYTES) for _ in range(SLOTS_PER_WORKER)]
+            for _ in range(num_workers)
+        ]
+        self.results = self.ctx.Queue()
+        self.tasks = [None] * num_workers
+        self.processes = [None] * num_workers
+        self.started_at = [0.0] * num_workers
+        self.crashes = [0] * num_workers
+        self.next_restart = [None] * num_workers  # When a crashed worker may be restarted
+        self.disabled = [False] * num_workers      # Workers that crashed MAX_RESTARTS times in a row
+        self.stopping = [False] * num_workers      # Wedged workers that were terminated
+        self.free_slots = [list(range(SLOTS_PER_WORKER)) for _ in range(num_workers)]
+        self.in_flight = {}  # request_id -> (worker, slot, future)
+        self.request_ids = itertools.count()
+        self.lock = threading.Condition()
+        self.closed = False
+
+        for i in range(num_workers):
+            self._start_worker(i)
+
+        threading.Thread(target=self._collect_results, daemon=True).start()
+        threading.Thread(target=self._watch_workers, daemon=True).start()
+
+    @property
+    def available(self):
+        """False once every worker has been given up on; callers should run in-process then."""
+        return not all(self.disabled)
+
+    def _start_worker(self, i):
+        """(Re)start replica i with a fresh task queue."""
+        self.tasks[i] = self.ctx.Queue()
+        self.processes[i] = self.ctx.Process(
+            target=worker_main,
+            args=(self.weights, self.cores[i], self.threads,
+                  [shm.name for shm in self.shm[i]], self.tasks[i], self.results),
+            daemon=True
+        )
+        self.processes[i].start()
+        self.started_at[i] = time.monotonic()
+
+    def _release(self, request_id):
+        """Free the slot used by a request and return its future (call with the lock held)."""
+        worker, slot, future = self.in_flight.pop(request_id)
+        self.free_slots[worker].append(slot)
+        self.lock.notify_all()
+        return future
+
+    def _collect_results(self):
+        """Resolve futures as replicas report back."""
+        while not self.closed:
+            try:
+                request_id, result, error = self.results.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if request_id not in self.in_flight:
+                    continue  # Already failed by a timeout or the crash watcher
+                future = self._release(request_id)
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def _handle_exit(self, i):
+        """Fail the requests a dead worker held and schedule its restart with backoff."""
+        process = self.processes[i]
+        if time.monotonic() - self.started_at[i] >= STABLE_SECONDS:
+            self.crashes[i] = 0
+        self.crashes[i] += 1
+
+        with self.lock:
+            self.stopping[i] = False
+            lost = [rid for rid, (worker, _, _) in self.in_flight.items() if worker == i]
+            futures = [self._release(rid) for rid in lost]
+            if self.crashes[i] > MAX_RESTARTS:
+                # Most likely bad weights or a model that can't load; stop burning CPU on it
+                self.disabled[i] = True
+                self.lock.notify_all()
+        for future in futures:
+            future.set_exception(RuntimeError("Inference worker crashed"))
+
+        if self.disabled[i]:
+            print(f"Inference worker {i} crashed {MAX_RESTARTS} times in a row, giving up on it")
+            if not self.available:
+                print("All inference workers failed, falling back to in-process inference")
+            return
+        delay = min(RESTART_BACKOFF_MAX, 2 ** (self.crashes[i] - 1))
+        print(f"Inference worker {i} exited (code {process.exitcode}), restarting in {delay}s")
+        self.next_restart[i] = time.monotonic() + delay
+
+    def _watch_workers(self):
+        """Restart crashed replicas with exponential backoff."""
+        while not self.closed:
+            time.sleep(1)
+            for i, process in enumerate(self.processes):
+                if self.closed or self.disabled[i]:
+                    continue
+                if self.next_restart[i] is not None:
+                    if time.monotonic() >= self.next_restart[i]:
+                        with self.lock:
+                            self._start_worker(i)
+                            self.next_restart[i] = None
+                            self.lock.notify_all()
+                elif not process.is_alive():
+                    self._handle_exit(i)
+
+    def _usable(self, i):
+        """A worker can take requests if it is running and has a free slot."""
+        return (not self.disabled[i] and not self.stopping[i] and
+                self.next_restart[i] is None and bool(self.free_slots[i]))
+
+    def infer(self, img):
+        """Run detection on a BGR image in the least-loaded replica.
+
+        Raises TimeoutError if no slot frees up or the worker doesn't answer in time,
+        and RuntimeError if the worker fails or the pool is no longer available.
+        """
+        height, width = img.shape[:2]
+        if max(height, width) > MAX_FRAME_SIDE:
+            scale = MAX_FRAME_SIDE / max(height, width)
+            img = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+
+        deadline = time.monotonic() + INFERENCE_TIMEOUT
+        with self.lock:
+            # Least-loaded dispatch: the usable worker with the most free slots
+            while not any(self._usable(i) for i in range(self.num_workers)):
+                if not self.available:
+                    raise RuntimeError("Inference pool is unavailable")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No inference worker became free in time")
+                self.lock.wait(remaining)
+            worker = max((i for i in range(self.num_workers) if self._usable(i)),
+                         key=lambda i: len(self.free_slots[i]))
+            slot = self.free_slots[worker].pop()
+            request_id = next(self.request_ids)
+            future = Future()
+            self.in_flight[request_id] = (worker, slot, future)
+
+            # Copy the frame into the slot while the lock keeps it ours; only its shape goes
+            # through the queue
+            np.ndarray(img.shape, dtype=np.uint8, buffer=self.shm[worker][slot].buf)[:] = img
+            self.tasks[worker].put((request_id, slot, img.shape))
+
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            with self.lock:
+                answered = request_id not in self.in_flight
+                if not answered:
+                    self._release(request_id)
+                    # The worker is wedged rather than dead; kill it so the watcher restarts it
+                    self.stopping[worker] = True
+                    self.processes[worker].terminate()
+            if answered:
+                # The result or failure landed just as we timed out and is being set now
+                try:
+                    return future.result(timeout=1)
+                except FutureTimeoutError:
+                    pass
+            raise TimeoutError("Inference worker did not answer in time")
+
+    def close(self):
+        """Stop the replicas and release shared memory."""
+        self.closed = True
+        for i, process in enumerate(self.processes):
+            self.tasks[i].put(None)
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for slots in self.shm:
+            for shm in slots:
+                shm.close()
+                shm.unlink()
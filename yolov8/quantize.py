@@ -0,0 +1,116 @@
+import multiprocessing
+import glob
+import json
+import os
+import time
+from datetime import datetime
+from ultralytics import YOLO
+import cv2
+
+# ----------------------------
+# Quantization Settings
+# ----------------------------
+# fp32 weights produced by training.py
+FP32_WEIGHTS = r"runs\detect\train2\weights\best.pt"
+
+# Dataset config; its 'val' split (dataset/train) is used both for INT8 calibration and mAP
+DATA_CONFIG = r"C:\Users\Edrian\Documents\VSCodeProjects\CaniScan\yolov8\config.yaml"
+
+# Images used for the per-image latency comparison
+LATENCY_IMAGES = os.path.join("yolov8", "dataset", "train", "images")
+LATENCY_SAMPLES = 50   # How many images to time
+WARMUP_RUNS = 5        # Untimed runs so lazy initialization doesn't skew the numbers
+
+# The INT8 variant is refused if its mAP50 falls below this fraction of the fp32 mAP50
+MIN_MAP50_RATIO = 0.97
+
+# Where the report is written; app.py reads it before offering the INT8 variant
+REPORT_PATH = r"runs\detect\train2\weights\int8_report.json"
+
+IMGSZ = 640
+
+def measure_latency(model, image_paths):
+    """Return mean and p95 per-image inference latency in milliseconds."""
+    images = [cv2.imread(p) for p in image_paths]
+    images = [img for img in images if img is not None]
+
+    for img in images[:WARMUP_RUNS]:
+        model(img, imgsz=IMGSZ, verbose=False)
+
+    timings = []
+    for img in images:
+        start = time.perf_counter()
+        model(img, imgsz=IMGSZ, verbose=False)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        "mean_ms": round(sum(timings) / len(timings), 2),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        "images": len(timings)
+    }
+
+def evaluate(model, names):
+    """Run validation on the CPU and return overall and per-class mAP."""
+    metrics = model.val(data=DATA_CONFIG, imgsz=IMGSZ, device="cpu", verbose=False, plots=False)
+    per_class = {names[i]: round(float(m), 4) for i, m in enumerate(metrics.box.maps)}
+    return {
+        "map50": round(float(metrics.box.map50), 4),
+        "map50_95": round(float(metrics.box.map), 4),
+        "per_class_map50_95": per_class
+    }
+
+def main():
+    # Check the latency images up front so a long export isn't wasted on a missing dataset
+    image_paths = sorted(glob.glob(os.path.join(LATENCY_IMAGES, "*.jpg")))[:LATENCY_SAMPLES]
+    if not image_paths:
+        print(f"No .jpg images found in {LATENCY_IMAGES}, cannot measure latency. Run from the project root.")
+        return
+
+    fp32_model = YOLO(FP32_WEIGHTS)
+    names = fp32_model.names
+
+    # Export to OpenVINO INT8. Ultralytics calibrates the activations on the dataset in DATA_CONFIG.
+    print("Exporting INT8 model (calibrating on dataset)...")
+    int8_path = fp32_model.export(format="openvino", int8=True, data=DATA_CONFIG, imgsz=IMGSZ)
+    int8_model = YOLO(int8_path, task="detect")
+
+    print("Evaluating fp32 model...")
+    fp32_accuracy = evaluate(fp32_model, names)
+    print("Evaluating INT8 model...")
+    int8_accuracy = evaluate(int8_model, names)
+
+    print(f"Timing inference on {len(image_paths)} images...")
+    fp32_latency = measure_latency(YOLO(FP32_WEIGHTS), image_paths)
+    int8_latency = measure_latency(int8_model, image_paths)
+
+    map50_ratio = int8_accuracy["map50"] / fp32_accuracy["map50"] if fp32_accuracy["map50"] else 0.0
+    accepted = map50_ratio >= MIN_MAP50_RATIO
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "fp32_weights": FP32_WEIGHTS,
+        "int8_weights": str(int8_path),
+        "classes": list(names.values()),
+        "fp32": {"accuracy": fp32_accuracy, "latency": fp32_latency},
+        "int8": {"accuracy": int8_accuracy, "latency": int8_latency},
+        "map50_ratio": round(map50_ratio, 4),
+        "speedup": round(fp32_latency["mean_ms"] / int8_latency["mean_ms"], 2),
+        "min_map50_ratio": MIN_MAP50_RATIO,
+        "accepted": accepted
+    }
+
+    with open(REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"fp32 mAP50: {fp32_accuracy['map50']}  |  INT8 mAP50: {int8_accuracy['map50']}  ({map50_ratio:.1%})")
+    print(f"fp32 latency: {fp32_latency['mean_ms']} ms  |  INT8 latency: {int8_latency['mean_ms']} ms  ({report['speedup']}x)")
+    if accepted:
+        print(f"INT8 variant accepted. Report written to {REPORT_PATH}")
+    else:
+        print(f"INT8 variant REFUSED: mAP50 ratio below {MIN_MAP50_RATIO}. Report written to {REPORT_PATH}")
+
+# Required for Windows multiprocessing
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -1,7 +1,46 @@
 import multiprocessing
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+from datetime import datetime
 from ultralytics import YOLO
 import torch
 torch.cuda.empty_cache()
+
+# ----------------------------
+# Incremental Fine-Tuning Settings
+# ----------------------------
+# Weights currently served by app.py; incremental runs start from these
+DEPLOYED_WEIGHTS = r"runs\detect\train2\weights\best.pt"
+
+# Original dataset, and newly labeled clinic images in the same images/ + labels/ layout
+BASE_IMAGES = os.path.join("yolov8", "dataset", "train", "images")
+NEW_IMAGES = os.path.join("yolov8", "dataset", "new", "images")
+
+# Dedicated holdout set that no training run (full or incremental) ever sees.
+# config.yaml trains on all of dataset/train, so the holdout can't be carved out of it.
+HOLDOUT_IMAGES = os.path.join("yolov8", "dataset", "holdout", "images")
+
+# The INT8 report from quantize.py describes the old weights, so promotion invalidates it
+INT8_REPORT = r"runs\detect\train2\weights\int8_report.json"
+
+CLASS_NAMES = ["ringworm", "hotspot", "mange"]  # Must match config.yaml
+
+HOLDOUT_PERCENT = 10    # Fixed share of new images kept out of training and added to the holdout
+VAL_PERCENT = 10        # Share of the training pool used for per-epoch validation / best.pt selection
+REPLAY_RATIO = 3        # Old images replayed per new image, so the model doesn't forget
+INCREMENTAL_EPOCHS = 5
+INCREMENTAL_LR = 0.001  # Much smaller than a fresh run so we refine instead of overwrite
+
+# New weights are promoted only if holdout mAP50 doesn't drop by more than this
+MAX_MAP50_REGRESSION = 0.005
+
+LINEAGE_FILE = os.path.join("runs", "detect", "lineage.json")
+
 def main():
     # Create a new YOLO model from scratch using YOLOv8 Nano or smallest version
     model = YOLO("yolov8n.pt")  # or "yolov8s.pt"
@@ -35,7 +74,156 @@ def main():
         workers=4
     )
 
+def hash_bucket(image_path, salt=""):
+    """Stable 0-99 bucket for an image, based on its file name."""
+    digest = hashlib.md5((salt + os.path.basename(image_path)).encode("utf-8")).hexdigest()
+    return int(digest, 16) % 100
+
+def in_holdout(image_path):
+    """Deterministically assign a new image to the holdout set based on its file name."""
+    return hash_bucket(image_path) < HOLDOUT_PERCENT
+
+def write_data_yaml(path, train_list, val_list):
+    """Write a dataset YAML pointing at image list files."""
+    with open(path, "w") as f:
+        json.dump({  # JSON is valid YAML
+            "train": os.path.abspath(train_list),
+            "val": os.path.abspath(val_list),
+            "nc": len(CLASS_NAMES),
+            "names": CLASS_NAMES
+        }, f, indent=2)
+
+def file_sha256(path):
+    """Hash a weights file so lineage entries identify exactly which model was used."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def write_image_list(path, images):
+    """Write a YOLO image list file (labels are found by swapping images/ for labels/)."""
+    with open(path, "w") as f:
+        f.writelines(os.path.abspath(image) + "\n" for image in images)
+
+def holdout_metrics(weights, data_yaml, device):
+    """Validate a set of weights on the fixed holdout split."""
+    metrics = YOLO(weights).val(data=data_yaml, imgsz=640, device=device, plots=False, verbose=False)
+    return {"map50": round(float(metrics.box.map50), 4), "map50_95": round(float(metrics.box.map), 4)}
+
+def main_incremental():
+    """Fine-tune the deployed weights on new samples plus a replay subset of the old dataset."""
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print("Incremental training on device:", device)
+
+    all_new_images = sorted(glob.glob(os.path.join(NEW_IMAGES, "*.jpg")))
+    new_images = [image for image in all_new_images if not in_holdout(image)]
+    if not new_images:
+        print(f"No new images found in {NEW_IMAGES}, nothing to do.")
+        return
+
+    holdout_images = sorted(glob.glob(os.path.join(HOLDOUT_IMAGES, "*.jpg")))
+    if not holdout_images:
+        print(f"No holdout images found in {HOLDOUT_IMAGES}. Add labeled images that are "
+              f"not in dataset/train so new weights can be compared fairly.")
+        return
+    holdout = holdout_images + [image for image in all_new_images if in_holdout(image)]
+
+    base_images = sorted(glob.glob(os.path.join(BASE_IMAGES, "*.jpg")))
+    replay = random.Random(0).sample(base_images, min(len(base_images), len(new_images) * REPLAY_RATIO))
+
+    # Dataset files for this run
+    run_name = "incremental_" + datetime.now().strftime("%Y%m%d_%H%M%S")
+    work_dir = os.path.join("runs", "detect", run_name + "_data")
+    os.makedirs(work_dir, exist_ok=True)
+    # Ultralytics picks best.pt by the per-epoch val score, so training gets its own val
+    # split carved out of the training pool. The holdout is only used for the promotion gate.
+    pool = new_images + replay
+    val = [image for image in pool if hash_bucket(image, "val:") < VAL_PERCENT] or pool[:1]
+    val_set = set(val)
+    train = [image for image in pool if image not in val_set]
+
+    train_list = os.path.join(work_dir, "train.txt")
+    val_list = os.path.join(work_dir, "val.txt")
+    holdout_list = os.path.join(work_dir, "holdout.txt")
+    write_image_list(train_list, train)
+    write_image_list(val_list, val)
+    write_image_list(holdout_list, holdout)
+
+    data_yaml = os.path.join(work_dir, "data.yaml")
+    holdout_yaml = os.path.join(work_dir, "holdout.yaml")
+    write_data_yaml(data_yaml, train_list, val_list)
+    write_data_yaml(holdout_yaml, holdout_list, holdout_list)  # Only its val split is read
+
+    print(f"Training on {len(train)} images ({len(new_images)} new + {len(replay)} replayed, "
+          f"{len(val)} held for validation), gating on {len(holdout)} holdout images")
+
+    baseline = holdout_metrics(DEPLOYED_WEIGHTS, holdout_yaml, device)
+
+    # Short, low learning rate schedule starting from the deployed weights
+    model = YOLO(DEPLOYED_WEIGHTS)
+    model.train(
+        data=data_yaml,
+        epochs=INCREMENTAL_EPOCHS,
+        imgsz=640,
+        batch=-1,
+        device=device,
+        workers=4,
+        optimizer="AdamW",  # With the default "auto", Ultralytics ignores lr0
+        lr0=INCREMENTAL_LR,
+        warmup_epochs=0,
+        project=os.path.join("runs", "detect"),
+        name=run_name
+    )
+    candidate_weights = os.path.join(str(model.trainer.save_dir), "weights", "best.pt")
+    candidate = holdout_metrics(candidate_weights, holdout_yaml, device)
+
+    promoted = candidate["map50"] >= baseline["map50"] - MAX_MAP50_REGRESSION
+    parent_sha = file_sha256(DEPLOYED_WEIGHTS)
+    if promoted:
+        # Keep the previous weights next to the deployed ones so a promotion can be rolled back
+        backup = DEPLOYED_WEIGHTS.replace("best.pt", f"best_{parent_sha[:12]}.pt")
+        shutil.copy2(DEPLOYED_WEIGHTS, backup)
+        shutil.copy2(candidate_weights, DEPLOYED_WEIGHTS)
+        if os.path.exists(INT8_REPORT):
+            os.remove(INT8_REPORT)
+
+    entry = {
+        "run": run_name,
+        "created_at": datetime.now().isoformat(),
+        "parent_weights": DEPLOYED_WEIGHTS,
+        "parent_sha256": parent_sha,
+        "weights": candidate_weights,
+        "weights_sha256": file_sha256(candidate_weights),
+        "new_images": len(new_images),
+        "replay_images": len(replay),
+        "holdout_images": len(holdout),
+        "epochs": INCREMENTAL_EPOCHS,
+        "baseline_holdout": baseline,
+        "candidate_holdout": candidate,
+        "promoted": promoted
+    }
+
+    lineage = []
+    if os.path.exists(LINEAGE_FILE):
+        with open(LINEAGE_FILE, "r") as f:
+            lineage = json.load(f)
+    lineage.append(entry)
+    with open(LINEAGE_FILE, "w") as f:
+        json.dump(lineage, f, indent=2)
+
+    print(f"Holdout mAP50: deployed {baseline['map50']}  |  candidate {candidate['map50']}")
+    if promoted:
+        print(f"Promoted {candidate_weights} -> {DEPLOYED_WEIGHTS}")
+        print("INT8 report removed; re-run quantize.py to rebuild the INT8 variant from the new weights.")
+    else:
+        print("Candidate regressed on the holdout set, deployed weights left unchanged.")
+
 # Required for Windows multiprocessing
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    main()
\ No newline at end of file
+    # python training.py --incremental  -> fine-tune the deployed model on dataset/new
+    if "--incremental" in sys.argv:
+        main_incremental()
+    else:
+        main()
\ No newline at end of file